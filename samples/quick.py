@@ -1,14 +1,11 @@
 #!/usr/bin/env python
 
 import sys
+from collections import deque
 
 if "-p" in sys.argv or "--print" in sys.argv: # yeah I know argpase
     sys.stdout.write("hello, world (from stdout)\n")
     sys.stderr.write("hello, ctimer (from stderr)\n")
 
-# busy loop
-acc = 0
-while True:
-    acc += 1
-    if acc >= 1e6:
-        break
+# busy loop, consumed in C rather than one bytecode at a time
+deque(range(1000000), maxlen=0)
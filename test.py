@@ -4,12 +4,24 @@
 # -----
 # Run test: ./test.py
 
-import json
 import os
-import re
-import subprocess
 import sys
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import orjson as _json
+except ImportError:
+    try:
+        import ujson as _json
+    except ImportError:
+        import json as _json
+
+try:
+    import fastjsonschema
+except ImportError:
+    fastjsonschema = None
+
+# Bounds of the measured values: min <= value < max, None for no bound.
 # yapf: disable
 TESTS = [
     {
@@ -18,8 +30,8 @@ TESTS = [
         "child_exit": "timeout",
         "child_exit_repr": 1500,
         "child_exit_desc": "child runtime limit (ms)",
-        "time": lambda t: t >= 1500,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": 1500, "time_max": None,
+        "maxrss_min": 1000,
     },
     {
         # This test case verifies ctimer can handle timeout.
@@ -27,8 +39,8 @@ TESTS = [
         "child_exit": "timeout",
         "child_exit_repr": 1500,
         "child_exit_desc": "child runtime limit (ms)",
-        "time": lambda t: t >= 1500,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": 1500, "time_max": None,
+        "maxrss_min": 1000,
     },
     {
         # This test case verifies ctimer can handle normal execution
@@ -37,17 +49,17 @@ TESTS = [
         "child_exit": "return",
         "child_exit_repr": 0,
         "child_exit_desc": "exit code",
-        "time": lambda t: t < 500,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": None, "time_max": 500,
+        "maxrss_min": 1000,
     },
     {
         # This test verifies ctimer can handle a signal exit.
         "file": "samples/sigkill.py",
         "child_exit": "signal",
         "child_exit_repr": 9,  # SIGKILL value.
-        "child_exit_desc": re.compile(r".*kill.*", re.IGNORECASE),
-        "time": lambda t: t < 500,
-        "maxrss": lambda v: v >= 1000,
+        "child_exit_desc": ("contains", "kill"),  # Case-insensitive.
+        "time_min": None, "time_max": 500,
+        "maxrss_min": 1000,
     },
     {
         # This test case verifies that sleep time (1.0 sec not on processor)
@@ -56,8 +68,8 @@ TESTS = [
         "child_exit": "return",
         "child_exit_repr": 0,
         "child_exit_desc": "exit code",
-        "time": lambda t: t < 500,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": None, "time_max": 500,
+        "maxrss_min": 1000,
     },
     {
         # This test case verifies that ctimer can handle missing
@@ -66,8 +78,8 @@ TESTS = [
         "child_exit": "quit",
         "child_exit_repr": None,
         "child_exit_desc": "child error before exec",
-        "time": lambda t: t < 50,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": None, "time_max": 50,
+        "maxrss_min": 1000,
     },
     {
         # This test case verifies that ctimer can handle
@@ -76,114 +88,204 @@ TESTS = [
         "child_exit": "quit",
         "child_exit_repr": None,
         "child_exit_desc": "child error before exec",
-        "time": lambda t: t < 50,
-        "maxrss": lambda v: v >= 1000,
+        "time_min": None, "time_max": 50,
+        "maxrss_min": 1000,
     },
 ]
 # yapf: enable
 
-STATS_FILENAME = "stats.log"
+# ctimer writes the stats to this inherited fd, the write end of a pipe to
+# the test runner, so no stats file is created, read and removed per test.
+STATS_FD = 3
+STATS_FILENAME = "/dev/fd/%d" % STATS_FD
+STATS_BUFFER_SIZE = 4096  # ctimer formats its report in a 512-byte buffer.
+
+# Discard ctimer's stdout and stderr (and hence the inspected program's).
+SPAWN_FILE_ACTIONS = [
+    (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+    (os.POSIX_SPAWN_DUP2, 1, 2),
+]
+
+# Schema of ctimer's stats. All checks against it go through validate_stats(),
+# in this process: do not spawn a validator (e.g. python -m json.tool) per
+# test, as its startup would cost more than running the test itself.
+# yapf: disable
+STATS_SCHEMA = {
+    "type": "object",
+    "required": ["pid", "maxrss_kb", "exit", "times_ms"],
+    "additionalProperties": False,
+    "properties": {
+        "pid": {"type": "integer"},
+        "maxrss_kb": {"type": "integer"},
+        "exit": {
+            "type": "object",
+            "required": ["type", "repr", "desc"],
+            "additionalProperties": False,
+            "properties": {
+                "type": {"type": "string"},
+                "repr": {"type": ["integer", "null"]},
+                "desc": {"type": "string"},
+            },
+        },
+        "times_ms": {
+            "type": "object",
+            "required": ["total", "user", "sys"],
+            "additionalProperties": False,
+            "properties": {
+                "total": {"type": "number"},
+                "user": {"type": "number"},
+                "sys": {"type": "number"},
+            },
+        },
+    },
+}
+# yapf: enable
+
+# Types of the JSON schema subset used by STATS_SCHEMA.
+SCHEMA_TYPES = {
+    "object": dict,
+    "string": str,
+    "integer": int,
+    "number": (int, float),
+    "null": type(None),
+}
+
+OK_FORMAT = "\x1b[32m[OK] %s\x1b[0m\n"
+ERROR_FORMAT = "\x1b[31m[Error] %s\x1b[0m\n"
 
 
 def err(s):
     sys.stderr.write(s + "\n")
 
 
+def _check_schema(schema, obj, path):
+    """Fallback of fastjsonschema for the schema subset of STATS_SCHEMA."""
+    types = schema["type"]
+    if isinstance(types, str):
+        types = [types]
+    if isinstance(obj, bool) or not any(
+            isinstance(obj, SCHEMA_TYPES[t]) for t in types):
+        return "%s must be %s" % (path, " or ".join(types))
+    if not isinstance(obj, dict):
+        return None
+    properties = schema.get("properties", {})
+    for key in schema.get("required", []):
+        if key not in obj:
+            return "%s must contain '%s' property" % (path, key)
+    for key, value in obj.items():
+        if key in properties:
+            error = _check_schema(properties[key], value, path + "." + key)
+            if error:
+                return error
+        elif schema.get("additionalProperties", True) == False:
+            return "%s must not contain '%s' property" % (path, key)
+    return None
+
+
+if fastjsonschema:
+    _compiled_validate = fastjsonschema.compile(STATS_SCHEMA)
+
+
+def validate_stats(res_dict):
+    """Return None if res_dict conforms to STATS_SCHEMA, else the error."""
+    if not fastjsonschema:
+        return _check_schema(STATS_SCHEMA, res_dict, "data")
+    try:
+        _compiled_validate(res_dict)
+    except fastjsonschema.JsonSchemaException as e:
+        return e.message
+    return None
+
+
+def read_stats(fd):
+    """Read the stats from fd until EOF into a preallocated buffer."""
+    buffer = bytearray(STATS_BUFFER_SIZE)
+    view, size = memoryview(buffer), 0
+    while size < STATS_BUFFER_SIZE:
+        count = os.readv(fd, [view[size:]])
+        if count == 0:
+            break
+        size += count
+    return bytes(view[:size])
+
+
+def load_stats(data):
+    """Parse and validate stats bytes; return (stats, None) or (None, error)."""
+    try:
+        res_dict = _json.loads(data)
+    except ValueError as e:  # Base of the parsers' decode errors.
+        return None, "stats is not valid JSON: %s" % e
+    error = validate_stats(res_dict)
+    if error:
+        return None, error
+    return res_dict, None
+
+
 def run_one(test_item):
-    with open(os.devnull,
-              'w') as devnull:  # Python2 doesn't have subprocess.DEVNULL
-        exit_code = subprocess.Popen(' '.join(["./ctimer", test_item["file"]]),
-                                     shell=True,
-                                     env={"CTIMER_STATS": STATS_FILENAME},
-                                     stdout=devnull,
-                                     stderr=subprocess.STDOUT).wait()
-        if exit_code != 0:
-            err("%s: ctimer exits with %d" % (test_item["file"], exit_code))
-            return False
-    if not os.path.isfile(STATS_FILENAME):
-        err("%s: stat file not found" % test_item["file"])
+    # Each test gets its own ctimer process: ctimer reports getrusage() of
+    # RUSAGE_CHILDREN, which accumulates over all children it has waited for,
+    # so a long-lived ctimer serving several programs would report cumulative
+    # times and the largest max RSS seen so far, not those of one program.
+    read_fd, write_fd = os.pipe()  # Not inheritable by other tests' ctimer.
+    pid = os.posix_spawn(
+        "./ctimer", ["./ctimer", test_item["file"]],
+        {"CTIMER_STATS": STATS_FILENAME},
+        file_actions=SPAWN_FILE_ACTIONS +
+        [(os.POSIX_SPAWN_DUP2, write_fd, STATS_FD)])
+    os.close(write_fd)
+    exit_code = os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1])
+    data = read_stats(read_fd)
+    os.close(read_fd)
+    if exit_code != 0:
+        err("%s: ctimer exits with %d" % (test_item["file"], exit_code))
         return False
-    with open(STATS_FILENAME, 'r') as res_file:
-        res_dict = json.load(res_file)
-        os.remove(STATS_FILENAME)
-
-        def _has_primary_field(key, obj_type):
-            if key not in res_dict:
-                err("%s: result missing field '%s'" % (test_item["file"], key))
-                return False
-            if not isinstance(res_dict[key], obj_type):
-                err("%s: field '%s' should be of type '%s', but is '%s'" %
-                    (test_item["file"], key, obj_type, type(res_dict[key])))
-                return False
-            return True
-
-        def _has_secondary_field(primary, key, obj_type, *, nullable=False):
-            if key not in res_dict[primary]:
-                err("%s: result missing field '%s' in '%s'" %
-                    (test_item["file"], key, primary))
-                return False
-            if not isinstance(res_dict[primary][key], obj_type):
-                if (not nullable) or (res_dict[primary][key] != None):
-                    err("%s: result field '%s' in '%s' should be of type '%s'%s"
-                        ", but is '%s'" %
-                        (test_item["file"], key, primary, obj_type, " or None"
-                         if nullable else "", type(res_dict[primary][key])))
-                    return False
-            return True
-
-        if not (isinstance(res_dict, dict) and _has_primary_field("pid", int)
-                and _has_primary_field("maxrss_kb", int)
-                and _has_primary_field("exit", dict)
-                and _has_secondary_field("exit", "type", str)
-                and _has_secondary_field("exit", "repr", int, nullable=True)
-                and _has_secondary_field("exit", "desc", str)
-                and _has_primary_field("times_ms", dict)
-                and _has_secondary_field("times_ms", "total", float)
-                and _has_secondary_field("times_ms", "user", float)
-                and _has_secondary_field("times_ms", "sys", float)):
-            return False
-        if len(res_dict) != 4:
-            err("%s: result expects 4 fields, %d found" %
-                (test_item["file"], len(res_dict)))
-            return False
-        if not test_item["maxrss"](res_dict["maxrss_kb"]):
-            err("%s: max resident set size %d not in expected range" %
-                (test_item["file"], test_item["maxrss"]))
-            return False
-        if len(res_dict["exit"]) != 3:
-            err("%s: result['exit'] expects 3 fields, %d found" %
-                (test_item["file"], len(res_dict["exit"])))
-            return False
-        if len(res_dict["times_ms"]) != 3:
-            err("%s: result['times_ms'] expects 3 fields, %d found" %
-                (test_item["file"], len(res_dict["times_ms"])))
-            return False
-        if res_dict["exit"]["type"] != test_item["child_exit"]:
-            err("%s: exit type expects '%s', but is '%s'" %
-                (test_item["file"], test_item["child_exit"],
-                 res_dict["exit"]["type"]))
+    if not data:
+        err("%s: stats not received" % test_item["file"])
+        return False
+    res_dict, error = load_stats(data)
+    if error:
+        err("%s: %s" % (test_item["file"], error))
+        return False
+    if res_dict["maxrss_kb"] < test_item["maxrss_min"]:
+        err("%s: max resident set size %d not in expected range" %
+            (test_item["file"], res_dict["maxrss_kb"]))
+        return False
+    exit_info = res_dict["exit"]
+    if exit_info["type"] != test_item["child_exit"]:
+        err("%s: exit type expects '%s', but is '%s'" %
+            (test_item["file"], test_item["child_exit"], exit_info["type"]))
+        return False
+    if exit_info["repr"] != test_item["child_exit_repr"]:
+        err("%s: exit repr expects %s, but is %s" %
+            (test_item["file"], test_item["child_exit_repr"],
+             exit_info["repr"]))
+        return False
+    expected_desc, desc = test_item["child_exit_desc"], exit_info["desc"]
+    if isinstance(expected_desc, str):
+        if desc != expected_desc:
+            err("%s: exit desc expects '%s', but is '%s'" %
+                (test_item["file"], expected_desc, desc))
             return False
-        if res_dict["exit"]["repr"] != test_item["child_exit_repr"]:
-            err("%s: exit repr expects %s, but is %s" %
-                (test_item["file"], test_item["child_exit_repr"],
-                 res_dict["exit"]["repr"]))
+    elif isinstance(expected_desc, tuple):  # (kind, operand)
+        kind, operand = expected_desc
+        assert kind == "contains", "unknown desc check kind: %s" % kind
+        if operand not in desc.lower():
+            err("%s: exit desc expects to contain '%s', but is '%s'" %
+                (test_item["file"], operand, desc))
             return False
-        if isinstance(test_item["child_exit_desc"], str):
-            if res_dict["exit"]["desc"] != test_item["child_exit_desc"]:
-                err("%s: exit desc expects '%s', but is '%s'" %
-                    (test_item["file"], test_item["child_exit_desc"],
-                     res_dict["exit"]["desc"]))
-                return False
-        else:  # regex
-            if not test_item["child_exit_desc"].match(res_dict["exit"]["desc"]):
-                err("%s: exit desc expects pattern '%s', but is '%s'" %
-                    (test_item["file"], str(test_item["child_exit_desc"]),
-                     res_dict["exit"]["desc"]))
-                return False
-        if test_item["time"](res_dict["times_ms"]["total"]) == False:
-            err("%s: total time %d not in expected range" %
-                (test_item["file"], test_item["times_ms"]["total"]))
+    else:  # compiled regex
+        if not expected_desc.search(desc):
+            err("%s: exit desc expects pattern '%s', but is '%s'" %
+                (test_item["file"], expected_desc.pattern, desc))
             return False
+    total_time = res_dict["times_ms"]["total"]
+    if ((test_item["time_min"] is not None
+         and total_time < test_item["time_min"])
+            or (test_item["time_max"] is not None
+                and total_time >= test_item["time_max"])):
+        err("%s: total time %d not in expected range" %
+            (test_item["file"], total_time))
+        return False
     return True
 
 
@@ -191,17 +293,21 @@ def main():
     if not os.path.isfile("ctimer"):
         err("[Error] no executable 'ctimer' found; did you build ctimer?")
         return 1
-    error_count = 0
-    for test_item in TESTS:
-        if run_one(test_item):
-            print("\x1b[32m[OK] %s\x1b[0m" % test_item["file"])
-        else:
-            error_count += 1
-            print("\x1b[31m[Error] %s\x1b[0m" % test_item["file"])
+    # Do not oversubscribe the processors: contention skews the processor
+    # times reported around the timeout limit.
+    max_workers = min(len(TESTS), os.cpu_count() or 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_one, TESTS))
+    # Write the report in one go once all tests are done.
+    lines = [(OK_FORMAT if ok else ERROR_FORMAT) % test_item["file"]
+             for test_item, ok in zip(TESTS, results)]
+    error_count = results.count(False)
     if error_count:
-        print("error count: %d out of %d tests" % (error_count, len(TESTS)))
+        lines.append("error count: %d out of %d tests\n" %
+                     (error_count, len(TESTS)))
     else:
-        print("all is fine")
+        lines.append("all is fine\n")
+    sys.stdout.write("".join(lines))
     return 0 if error_count == 0 else 1
 
 